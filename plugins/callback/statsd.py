@@ -0,0 +1,447 @@
+# -*- coding: utf-8 -*-
+# Copyright: Ansible Project
+# GNU General Public License v3.0+ (see COPYING or https://www.gnu.org/licenses/gpl-3.0.txt)
+
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+DOCUMENTATION = '''
+    name: statsd
+    type: aggregate
+    short_description: Sends playbook metrics to StatsD
+    version_added: 2.2.0
+    author: "Mark Mercado (@mamercad)"
+    description:
+      - This callback plugin sends task results and playbook statistics to StatsD as counters and gauges.
+      - Counters track task results per host (for instance C(ok), C(failed)), gauges carry the task runtimes.
+    requirements:
+      - Whitelisting this callback plugin
+    options:
+      statsd_host:
+        description: StatsD host (hostname or IP) to send the metrics to.
+        type: str
+        default: localhost
+        env:
+          - name: STATSD_HOST
+        ini:
+          - section: callback_statsd
+            key: statsd_host
+      statsd_port:
+        description: The port on I(statsd_host) which StatsD is listening on.
+        type: int
+        default: 8125
+        env:
+          - name: STATSD_PORT
+        ini:
+          - section: callback_statsd
+            key: statsd_port
+      statsd_protocol:
+        description: The transport protocol to send the metrics over.
+        type: str
+        default: udp
+        choices: ["udp", "tcp"]
+        env:
+          - name: STATSD_PROTOCOL
+        ini:
+          - section: callback_statsd
+            key: statsd_protocol
+      statsd_unix_socket:
+        description:
+          - Path to a local StatsD Unix domain datagram socket, as used by a co-located Agent.
+          - When set, it takes precedence over I(statsd_host), I(statsd_port) and I(statsd_protocol)
+            and skips the network stack entirely.
+        type: path
+        env:
+          - name: STATSD_UNIX_SOCKET
+        ini:
+          - section: callback_statsd
+            key: statsd_unix_socket
+      statsd_maxudpsize:
+        description:
+          - The maximum size of a UDP datagram in bytes.
+          - Metrics are packed into datagrams up to this size; the default stays below the usual ethernet MTU.
+        type: int
+        default: 1432
+        env:
+          - name: STATSD_MAXUDPSIZE
+        ini:
+          - section: callback_statsd
+            key: statsd_maxudpsize
+'''
+
+EXAMPLES = '''
+examples: >
+  To enable, add this to your ansible.cfg file in the defaults block
+    [defaults]
+    callback_whitelist = community.general.statsd
+  Set the environment variables
+    export STATSD_HOST=127.0.0.1
+    export STATSD_PORT=8125
+  Or set the ansible.cfg variables in the callback_statsd block
+    [callback_statsd]
+    statsd_host = 127.0.0.1
+    statsd_port = 8125
+'''
+
+import socket
+import threading
+
+from collections import defaultdict
+from os.path import basename, splitext
+
+try:
+    from time import monotonic
+except ImportError:  # Python 2
+    from time import time as monotonic
+
+from ansible.module_utils._text import to_bytes
+from ansible.module_utils.six.moves import queue
+from ansible.plugins.callback import CallbackBase
+
+_SENTINEL = object()
+
+
+def _sanitize(name):
+    # dots are the StatsD namespace separator, and spaces and colons
+    # confuse exporters; replace them once up front so free-form play and
+    # task names cannot explode the metric namespace
+    return name.replace('.', '_').replace(' ', '_').replace(':', '_')
+
+
+class StatsD(object):
+    def __init__(self):
+        self.statsd_host = None
+        self.statsd_port = None
+        self.statsd_protocol = 'udp'
+        self.statsd_maxudpsize = 1432
+        self.statsd_unix_socket = None
+        self._addr = None
+        self.ansible_basedir = ""
+        self.ansible_playbook = ""
+        self.ansible_play = ""
+        self.ansible_task = ""
+        self._sock = None
+        self._counters = defaultdict(int)
+        self._gauges = {}
+        self._queue = None
+        self._thread = None
+        self._dropped = 0
+
+    def resolve(self):
+        # resolve the server address once instead of paying for a
+        # getaddrinfo lookup on every connect or sendto
+        if self.statsd_unix_socket:
+            self._addr = self.statsd_unix_socket
+            return
+        if self.statsd_protocol == 'udp':
+            socktype = socket.SOCK_DGRAM
+        else:
+            socktype = socket.SOCK_STREAM
+        try:
+            self._addr = socket.getaddrinfo(self.statsd_host, self.statsd_port, socket.AF_INET, socktype)[0][4]
+        except socket.error:
+            self._addr = (self.statsd_host, self.statsd_port)
+
+    def connect(self):
+        if self._addr is None:
+            self.resolve()
+        if self.statsd_unix_socket:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._sock.connect(self._addr)
+        elif self.statsd_protocol == 'udp':
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        else:
+            self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            # without TCP_NODELAY Nagle's algorithm holds small metric
+            # writes back for up to 200 ms; a bigger send buffer keeps
+            # bursts during a play from blocking the writer
+            self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+            self._sock.connect(self._addr)
+        # telemetry must never stall the run: if a send would block it is
+        # dropped (and counted) instead
+        self._sock.setblocking(False)
+
+    def incr(self, name, value=1):
+        self._counters[name] += value
+
+    def gauge(self, name, value):
+        self._gauges[name] = value
+
+    def flush(self):
+        # many hosts hitting the same task collapse into a single counter
+        # line here, so the number of packets scales with the number of
+        # metric names rather than with the number of events; each unique
+        # line is encoded exactly once and stays bytes from here on
+        metrics = []
+        for name, value in self._counters.items():
+            metrics.append(to_bytes('%s:%s|c' % (name, value)))
+        for name, value in self._gauges.items():
+            metrics.append(to_bytes('%s:%s|g' % (name, value)))
+        if metrics:
+            self.send_metrics(metrics)
+        self._counters.clear()
+        self._gauges.clear()
+
+    def send_metric(self, metric):
+        self.send_metrics([to_bytes(metric)])
+
+    def send_metrics(self, metrics):
+        # hand the batch to the writer thread so the callback (and with it
+        # the strategy) never waits on the network; if the queue is full,
+        # dropping telemetry beats stalling the playbook
+        if self._thread is None:
+            self._queue = queue.Queue(maxsize=10000)
+            self._thread = threading.Thread(target=self._writer)
+            self._thread.daemon = True
+            self._thread.start()
+        try:
+            self._queue.put_nowait(metrics)
+        except queue.Full:
+            self._dropped += len(metrics)
+
+    def _writer(self):
+        while True:
+            metrics = self._queue.get()
+            if metrics is _SENTINEL:
+                break
+            try:
+                self._transmit(metrics)
+            except socket.error:
+                # connect() failed, so the whole batch was lost
+                self._dropped += len(metrics)
+
+    def _transmit(self, metrics):
+        # the socket is created lazily on the first metric and kept open
+        # until close() so that every emission does not pay for a TCP
+        # handshake and teardown; StatsD accepts newline separated
+        # multi-metric payloads, so a whole batch costs one sendall()
+        if self._sock is None:
+            self.connect()
+        if self.statsd_unix_socket or self.statsd_protocol == 'udp':
+            self._send_datagrams(metrics)
+            return
+        payload = b'\n'.join(metrics) + b'\n'
+        try:
+            self._sock.sendall(payload)
+        except socket.error:
+            # the server went away or the buffer is full; reconnect once
+            # and retry, then drop rather than stall
+            try:
+                self._close_sock()
+                self.connect()
+                self._sock.sendall(payload)
+            except socket.error:
+                self._dropped += len(metrics)
+
+    def _send_datagram(self, payload, count):
+        if self._addr is None:
+            self.resolve()
+        try:
+            if self.statsd_unix_socket:
+                # the AF_UNIX socket is connected, no address needed
+                self._sock.send(payload)
+            else:
+                self._sock.sendto(payload, self._addr)
+        except socket.error:
+            self._dropped += count
+
+    def _send_datagrams(self, metrics):
+        # pack newline separated metrics into datagrams no larger than
+        # statsd_maxudpsize so a batch coalesces into few packets without
+        # risking IP fragmentation
+        buf = b''
+        buffered = 0
+        for metric in metrics:
+            line = metric + b'\n'
+            if buf and len(buf) + len(line) > self.statsd_maxudpsize:
+                self._send_datagram(buf[:-1], buffered)
+                buf = b''
+                buffered = 0
+            buf += line
+            buffered += 1
+        if buf:
+            self._send_datagram(buf[:-1], buffered)
+
+    def _close_sock(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(_SENTINEL)
+            self._thread.join(timeout=5)
+            self._thread = None
+            self._queue = None
+        self._close_sock()
+
+
+class CallbackModule(CallbackBase):
+    CALLBACK_VERSION = 2.0
+    CALLBACK_TYPE = 'aggregate'
+    CALLBACK_NAME = 'community.general.statsd'
+    CALLBACK_NEEDS_WHITELIST = True
+
+    def __init__(self, display=None):
+        super(CallbackModule, self).__init__(display=display)
+        self.start_times = {'playbook': None, 'play': None, 'task': {}}
+        self._task_refcount = {}
+        self._play_host_count = None
+        self.statsd = StatsD()
+        self._base_prefix_counter = ''
+        self._base_prefix_gauge = ''
+        self._stats_prefix_counter = ''
+        self._stats_gauge = ''
+        self._task_prefix_counter = ''
+        self._task_prefix_gauge = ''
+        self._verbose = False
+
+    def _task_runtime(self, result):
+        task_uuid = result._task._uuid
+        start = self.start_times['task'].get(task_uuid)
+        if start is None:
+            return 0.0
+        # several hosts share a task uuid, so the timestamp can only be
+        # expired once the last expected host has reported in; this keeps
+        # the dict bounded by the number of in-flight tasks instead of
+        # growing for the whole run
+        remaining = self._task_refcount.get(task_uuid)
+        if remaining is not None:
+            if remaining > 1:
+                self._task_refcount[task_uuid] = remaining - 1
+            else:
+                del self._task_refcount[task_uuid]
+                del self.start_times['task'][task_uuid]
+        return monotonic() - start
+
+    def _playbook_runtime(self):
+        return monotonic() - self.start_times['playbook']
+
+    def set_options(self, task_keys=None, var_options=None, direct=None):
+        super(CallbackModule, self).set_options(task_keys=task_keys,
+                                                var_options=var_options,
+                                                direct=direct)
+
+        self.statsd.statsd_host = self.get_option('statsd_host')
+        self.statsd.statsd_port = self.get_option('statsd_port')
+        self.statsd.statsd_protocol = self.get_option('statsd_protocol')
+        self.statsd.statsd_maxudpsize = self.get_option('statsd_maxudpsize')
+        self.statsd.statsd_unix_socket = self.get_option('statsd_unix_socket')
+        self.statsd.resolve()
+
+        # cache the verbosity check so the per-event handlers only test a
+        # plain boolean and build no diagnostic strings in the common case
+        self._verbose = bool(self._display.verbosity)
+
+        if self._verbose:
+            self._display.display('statsd_host %s' % self.statsd.statsd_host)
+            self._display.display('statsd_port %s' % self.statsd.statsd_port)
+            self._display.display('statsd_protocol %s' % self.statsd.statsd_protocol)
+
+    def v2_playbook_on_start(self, playbook):
+        self.statsd.ansible_basedir = _sanitize(basename(playbook._basedir))
+        self.statsd.ansible_playbook = _sanitize(splitext(basename(playbook._file_name))[0])
+        # everything below the basedir/playbook level hangs off these
+        # prefixes, so format them exactly once per playbook
+        self._base_prefix_counter = 'ansible.counter.%s.%s.' % (
+            self.statsd.ansible_basedir, self.statsd.ansible_playbook)
+        self._base_prefix_gauge = 'ansible.gauge.%s.%s.' % (
+            self.statsd.ansible_basedir, self.statsd.ansible_playbook)
+        self._stats_prefix_counter = 'ansible.counter.stats.%s.%s' % (
+            self.statsd.ansible_basedir, self.statsd.ansible_playbook)
+        self._stats_gauge = 'ansible.gauge.stats.%s.%s' % (
+            self.statsd.ansible_basedir, self.statsd.ansible_playbook)
+        self.start_times['playbook'] = monotonic()
+
+    def v2_playbook_on_play_start(self, play):
+        self.statsd.ansible_play = _sanitize(str(play))
+        try:
+            self._play_host_count = len(play.get_variable_manager()._inventory.get_hosts(play.hosts))
+        except Exception:
+            # inventory size unknown; keep the task timestamps until the
+            # end of the run instead of refcounting them away
+            self._play_host_count = None
+        self.start_times['play'] = monotonic()
+
+    def _on_task_start(self, task):
+        self.statsd.ansible_task = _sanitize(str(task.get_name()))
+        # the prefix only changes per task, so build it here once instead
+        # of re-interpolating the same strings for every host event
+        self._task_prefix_counter = ''.join((
+            self._base_prefix_counter, self.statsd.ansible_play, '.',
+            self.statsd.ansible_task, '.'))
+        self._task_prefix_gauge = ''.join((
+            self._base_prefix_gauge, self.statsd.ansible_play, '.',
+            self.statsd.ansible_task, '.'))
+        self.start_times['task'][task._uuid] = monotonic()
+        if self._play_host_count:
+            self._task_refcount[task._uuid] = self._play_host_count
+
+    def v2_playbook_on_task_start(self, task, is_conditional):
+        self._on_task_start(task)
+
+    def v2_playbook_on_handler_task_start(self, task):
+        self._on_task_start(task)
+
+    def _send_task_metrics(self, result, suffix):
+        # one join of (cached prefix, host, constant suffix) is all the
+        # string work left on the per-event path; encoding happens once
+        # per batch at flush time
+        host = result._host.get_name()
+        runtime = self._task_runtime(result)
+        counter = ''.join((self._task_prefix_counter, host, suffix))
+        gauge = ''.join((self._task_prefix_gauge, host, suffix))
+        if self._verbose:
+            self._display.display('counter %s' % counter)
+            self._display.display('gauge %s' % gauge)
+        self.statsd.incr(counter)
+        self.statsd.gauge(gauge, runtime)
+
+    def v2_runner_on_ok(self, result, **kwargs):
+        self._send_task_metrics(result, '.ok')
+
+    def v2_runner_on_failed(self, result, ignore_errors=False, **kwargs):
+        self._send_task_metrics(result, '.failed')
+
+    def v2_runner_on_skipped(self, result, **kwargs):
+        self._send_task_metrics(result, '.skipped')
+
+    def v2_runner_on_unreachable(self, result, **kwargs):
+        self._send_task_metrics(result, '.unreachable')
+
+    def v2_runner_on_async_ok(self, result, **kwargs):
+        self._send_task_metrics(result, '.async_ok')
+
+    def v2_runner_on_async_failed(self, result, **kwargs):
+        self._send_task_metrics(result, '.async_failed')
+
+    def v2_playbook_on_stats(self, stats):
+        runtime = self._playbook_runtime()
+        # the playbook runtime gauge does not depend on the loop keys at
+        # all, so emit it once instead of once per (k1, k2) pair
+        if self._verbose:
+            self._display.display('gauge %s' % self._stats_gauge)
+        self.statsd.gauge(self._stats_gauge, runtime)
+        for k1, v1 in stats.__dict__.items():
+            if not v1:
+                continue
+            for k2, v2 in v1.items():
+                # stats.custom holds nested dicts from set_stats, not
+                # counts; only integer values are StatsD counters
+                if not isinstance(v2, int):
+                    continue
+                counter = '%s.%s.%s' % (self._stats_prefix_counter, k1, k2)
+                if self._verbose:
+                    self._display.display('counter %s' % counter)
+                self.statsd.incr(counter, v2)
+        self.start_times['task'].clear()
+        self._task_refcount.clear()
+        # the drop count has to be folded in before the final flush, so
+        # metrics lost during that flush itself go unreported; a counter
+        # that under-reports drops beats reopening the connection for one
+        # extra line
+        if self.statsd._dropped:
+            self.statsd.incr(self._stats_prefix_counter + '.statsd_dropped', self.statsd._dropped)
+        self.statsd.flush()
+        self.statsd.close()
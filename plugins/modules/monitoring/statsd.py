@@ -14,7 +14,7 @@ description:
   - The C(statsd) module sends metrics to StatsD.
   - For more information, see U(https://statsd-metrics.readthedocs.io/en/latest/).
   - Supported metric types are C(counter) and C(gauge).
-    Currently unupported metric types are C(timer), C(set), and C(gaugedelta).
+    Currently unsupported metric types are C(timer), C(set), and C(gaugedelta).
 author: "Mark Mercado (@mamercad)"
 requirements:
   - statsd
@@ -59,6 +59,7 @@ options:
       - The type of metric.
   metric_prefix:
     type: str
+    default: ''
     description:
       - The prefix to add to the metric.
   value:
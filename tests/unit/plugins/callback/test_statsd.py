@@ -0,0 +1,137 @@
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+from __future__ import (absolute_import, division, print_function)
+__metaclass__ = type
+
+import socket
+
+from ansible.executor.stats import AggregateStats
+from ansible_collections.community.general.tests.unit.compat import unittest
+from ansible_collections.community.general.tests.unit.compat.mock import Mock
+from ansible_collections.community.general.plugins.callback.statsd import CallbackModule, StatsD
+
+
+class TestStatsDSink(unittest.TestCase):
+    def setUp(self):
+        self.statsd = StatsD()
+        self.statsd.statsd_host = 'localhost'
+        self.statsd.statsd_port = 8125
+        self.statsd.statsd_protocol = 'tcp'
+        self.sock = Mock()
+        self.statsd._sock = self.sock
+
+    def _flushed_lines(self):
+        self.statsd.flush()
+        # close() drains the writer thread before the socket goes away
+        self.statsd.close()
+        payloads = [call[0][0] for call in self.sock.sendall.call_args_list]
+        return b''.join(payloads).decode().splitlines()
+
+    def test_counters_aggregate_before_emit(self):
+        self.statsd.incr('ansible.counter.mytask.myhost.ok')
+        self.statsd.incr('ansible.counter.mytask.myhost.ok')
+        self.statsd.incr('ansible.counter.mytask.myhost.ok')
+        self.statsd.incr('ansible.counter.stats.ok', 7)
+
+        lines = self._flushed_lines()
+
+        self.assertEqual(self.sock.sendall.call_count, 1)
+        self.assertIn('ansible.counter.mytask.myhost.ok:3|c', lines)
+        self.assertIn('ansible.counter.stats.ok:7|c', lines)
+
+    def test_gauges_keep_last_value(self):
+        self.statsd.gauge('ansible.gauge.mytask.myhost.ok', 1.5)
+        self.statsd.gauge('ansible.gauge.mytask.myhost.ok', 2.5)
+
+        lines = self._flushed_lines()
+
+        self.assertIn('ansible.gauge.mytask.myhost.ok:2.5|g', lines)
+
+    def test_flush_clears_aggregates(self):
+        self.statsd.incr('ansible.counter.mytask.myhost.ok')
+        self.statsd.flush()
+        self.statsd.flush()
+        self.statsd.close()
+
+        self.assertEqual(self.sock.sendall.call_count, 1)
+
+    def test_empty_flush_sends_nothing(self):
+        self.statsd.flush()
+        self.statsd.close()
+
+        self.assertEqual(self.sock.sendall.call_count, 0)
+
+    def test_udp_datagrams_respect_maxudpsize(self):
+        self.statsd.statsd_protocol = 'udp'
+        self.statsd.statsd_maxudpsize = 40
+
+        metrics = [b'metric%02d:1|c' % i for i in range(10)]
+        self.statsd.send_metrics(metrics)
+        self.statsd.close()
+
+        datagrams = [call[0][0] for call in self.sock.sendto.call_args_list]
+        self.assertTrue(len(datagrams) > 1)
+        for datagram in datagrams:
+            self.assertTrue(len(datagram) <= 40)
+        lines = [line for datagram in datagrams for line in datagram.split(b'\n')]
+        self.assertEqual(lines, metrics)
+
+    def test_unix_socket_uses_connected_datagrams(self):
+        self.statsd.statsd_unix_socket = '/run/statsd.sock'
+
+        self.statsd.send_metrics([b'mycounter:1|c', b'mygauge:2|g'])
+        self.statsd.close()
+
+        self.sock.send.assert_called_once_with(b'mycounter:1|c\nmygauge:2|g')
+        self.assertEqual(self.sock.sendto.call_count, 0)
+
+    def test_stats_skip_custom_set_stats_values(self):
+        # AggregateStats.custom holds nested dicts from set_stats; the
+        # stats handler must skip them instead of trying to count them
+        callback = CallbackModule()
+        callback.statsd = self.statsd
+
+        playbook = Mock()
+        playbook._basedir = '/home/user/myproject'
+        playbook._file_name = 'site.yml'
+        callback.v2_playbook_on_start(playbook)
+
+        stats = AggregateStats()
+        stats.increment('ok', 'myhost')
+        stats.custom = {'myhost': {'mykey': 'myvalue'}, '_run': {'mykey': 'myvalue'}}
+        callback.v2_playbook_on_stats(stats)
+
+        payloads = [call[0][0] for call in self.sock.sendall.call_args_list]
+        lines = b''.join(payloads).decode().splitlines()
+        self.assertIn('ansible.counter.stats.myproject.site.ok.myhost:1|c', lines)
+        self.assertFalse(any('custom' in line for line in lines))
+
+    def test_failed_sends_are_counted_as_drops(self):
+        self.statsd.statsd_protocol = 'udp'
+        self.sock.sendto.side_effect = socket.error
+
+        self.statsd.send_metrics([b'mycounter:1|c', b'mygauge:2|g'])
+        self.statsd.close()
+
+        self.assertEqual(self.statsd._dropped, 2)
+
+    def test_connect_failures_are_counted_as_drops(self):
+        self.statsd._sock = None
+        self.statsd.connect = Mock(side_effect=socket.error)
+
+        self.statsd.send_metrics([b'mycounter:1|c', b'mygauge:2|g'])
+        self.statsd.close()
+
+        self.assertEqual(self.statsd._dropped, 2)